@@ -7,6 +7,11 @@ import traceback
 
 import structlog
 
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
 _logger = structlog.get_logger(__name__)
 
 
@@ -41,6 +46,8 @@ async def main_async():
 
 
 def main():
+    if uvloop is not None:
+        uvloop.install()
     # noinspection PyBroadException
     try:
         return asyncio.run(main_async())
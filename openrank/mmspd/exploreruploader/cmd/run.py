@@ -1,17 +1,39 @@
 import argparse
 import asyncio
-import contextlib
+import io
 import json
+import os
 import pathlib
-import tempfile
+import sqlite3
 import traceback
 import zipfile
 from argparse import ArgumentParser
 from datetime import datetime
-from functools import reduce
 
-import aioboto3
+import boto3.session
+import ijson
 import structlog
+from boto3.s3.transfer import TransferConfig, create_transfer_manager
+
+try:
+    import libarchive.public
+except ImportError:
+    libarchive = None
+
+try:
+    import orjson
+
+    def _json_loads(data: bytes) -> object:
+        return orjson.loads(data)
+
+    def _json_dumps(obj: object) -> bytes:
+        return orjson.dumps(obj)
+except ImportError:
+    def _json_loads(data: bytes) -> object:
+        return json.loads(data)
+
+    def _json_dumps(obj: object) -> bytes:
+        return json.dumps(obj).encode()
 
 _logger: structlog.BoundLoggerBase = structlog.get_logger(__name__)
 
@@ -23,6 +45,21 @@ async def setup_parser(parser: ArgumentParser):
                         help="""AWS region name""")
     parser.add_argument('--s3-uploaders', metavar='NUM', type=int, default=10,
                         help="""number of parallel S3 uploader tasks""")
+    parser.add_argument('--s3-part-size-mb', metavar='MB', type=int,
+                        default=50,
+                        help="""multipart upload part size/threshold (MiB)""")
+    parser.add_argument('--s3-per-file-concurrency', metavar='NUM', type=int,
+                        default=8,
+                        help="""concurrent S3 requests budgeted per upload;
+                                the shared transfer thread pool is sized
+                                s3-uploaders times this""")
+    parser.add_argument('--use-libarchive', action='store_true',
+                        help="""enumerate/decompress score zips with
+                                C-backed libarchive when available""")
+    parser.add_argument('--state-db', metavar='FILE', type=pathlib.Path,
+                        default=pathlib.Path('mmspd-explorer-uploader.db'),
+                        help="""SQLite file holding seen-manifest state
+                                across restarts""")
     parser.add_argument('s3_bucket', metavar='BUCKET',
                         help="""AWS S3 bucket name""")
     parser.add_argument('indexer_cache', type=pathlib.Path,
@@ -32,160 +69,422 @@ async def setup_parser(parser: ArgumentParser):
                         help="""output directory to scan""")
 
 
-def parse_timestamp(s: str) -> datetime:
+try:
+    from ciso8601 import parse_datetime as parse_timestamp
+except ImportError:
+    def parse_timestamp(s: str) -> datetime:
+        # fromisoformat handles both fractional and whole seconds,
+        # and is ~20x faster than strptime on this format.
+        return datetime.fromisoformat(s.replace('Z', '+00:00'))
+
+
+def peek_manifest(path: pathlib.Path) -> tuple:
+    """Extract epoch/issuanceDate/scope from a manifest by streaming,
+    without materializing the (potentially large) manifest dict."""
+    epoch = ts = scope = None
+    with path.open('rb') as f:
+        for key, value in ijson.kvitems(f, ''):
+            match key:
+                case 'epoch':
+                    epoch = value
+                case 'issuanceDate':
+                    ts = value
+                case 'scope':
+                    scope = value
+            if epoch is not None and ts is not None and scope is not None:
+                break
+    return epoch, ts, scope
+
+
+def load_state(db: sqlite3.Connection) -> tuple[dict, dict, set, dict]:
+    """Load persisted manifests into the in-memory indexes, creating
+    the schema on first use.
+
+    Returns (manifest_by_scope_ts, timestamps_by_epoch_scope, seen_ts0,
+    uploaded), where uploaded maps already-uploaded S3 keys to their
+    object sizes."""
+    db.execute('''CREATE TABLE IF NOT EXISTS manifests (
+                      scope TEXT,
+                      ts0 INT,
+                      epoch TEXT,
+                      manifest BLOB,
+                      PRIMARY KEY (scope, ts0))''')
+    db.execute('''CREATE TABLE IF NOT EXISTS uploads (
+                      key TEXT PRIMARY KEY,
+                      size INT)''')
+    manifest_by_scope_ts = dict[str, dict[int, dict]]()
+    timestamps_by_epoch_scope = dict[datetime, dict[str, set[int]]]()
+    seen_ts0 = set[int]()
+    for scope, ts0, epoch_str, blob in db.execute(
+            'SELECT scope, ts0, epoch, manifest FROM manifests'):
+        epoch = parse_timestamp(epoch_str)
+        manifest_by_scope_ts.setdefault(scope, {})[ts0] = _json_loads(blob)
+        timestamps_by_epoch_scope \
+            .setdefault(epoch, {}) \
+            .setdefault(scope, set()) \
+            .add(ts0)
+        seen_ts0.add(ts0)
+    uploaded = dict(db.execute('SELECT key, size FROM uploads'))
+    return (manifest_by_scope_ts, timestamps_by_epoch_scope, seen_ts0,
+            uploaded)
+
+
+def list_uploaded(s3, bucket: str) -> dict[str, int]:
+    """List already-uploaded score file keys and sizes from S3."""
+    found = dict[str, int]()
+    for page in s3.get_paginator('list_objects_v2').paginate(
+            Bucket=bucket, Prefix='files/'):
+        for obj in page.get('Contents', ()):
+            found[obj['Key']] = obj['Size']
+    return found
+
+
+class _OwnedZipFile(zipfile.ZipFile):
+    """ZipFile that also closes the file object handed to it."""
+
+    def close(self):
+        fp = self.fp
+        try:
+            super().close()
+        finally:
+            if fp is not None:
+                fp.close()
+
+
+def open_zip(path: pathlib.Path) -> zipfile.ZipFile:
+    """Open a score zip through a 1MiB buffered reader, so the many
+    small central-directory and local-header reads hit the buffer
+    instead of the filesystem."""
+    buffered = io.BufferedReader(open(path, 'rb', buffering=0),
+                                 buffer_size=1 << 20)
     try:
-        return datetime.strptime(s, '%Y-%m-%dT%H:%M:%S.%f%z')
-    except ValueError:
-        return datetime.strptime(s, '%Y-%m-%dT%H:%M:%S%z')
+        return _OwnedZipFile(buffered)
+    except Exception:
+        buffered.close()
+        raise
 
 
-def rm_rf(path: pathlib.Path):
-    if path.is_dir() and not path.is_symlink():
-        for child in path.iterdir():
-            rm_rf(child)
-        path.rmdir()
+def process_manifest(path: pathlib.Path, ts0: int,
+                     manifest_by_scope_ts: dict,
+                     use_libarchive: bool = False) -> tuple | None:
+    """Blocking per-manifest work: peek/parse the manifest and list the
+    zip members to upload.  Runs in a worker thread off the event loop.
+
+    Returns (scope, ts0, epoch, manifest, z, members) where z is the
+    open score zip (the caller closes it once the member uploads are
+    done; None with libarchive) and members are (member, key,
+    compat_key, size, data) upload jobs with data pre-decompressed for
+    libarchive and None otherwise, or None if the manifest should be
+    skipped."""
+    logger = _logger.bind(path=path)
+    try:
+        epoch_str, ts_str, scope = peek_manifest(path)
+    except (OSError, ijson.JSONError):
+        logger.error("cannot load manifest", exc=traceback.format_exc())
+        return None
+    if epoch_str is None or ts_str is None or scope is None:
+        # logger.error("invalid manifest")
+        return None
+    try:
+        epoch = parse_timestamp(epoch_str)
+        # ts0 from the filename is authoritative; parse to validate.
+        ts = parse_timestamp(ts_str)
+    except ValueError:
+        logger.error("invalid epoch/issuance/effective date",
+                     exc=traceback.format_exc())
+        return None
+    if epoch.tzinfo is None or ts.tzinfo is None:
+        # fromisoformat/ciso8601 accept timezone-naive strings, which
+        # would poison epoch comparisons against aware datetimes.
+        logger.error("naive epoch/issuance date")
+        return None
+    if not isinstance(scope, str):
+        logger.error("scope not a string")
+        return None
+    try:
+        manifest_by_scope_ts[scope][ts0]
+    except KeyError:
+        pass
     else:
-        path.unlink(missing_ok=True)
-
-
-async def upload_to_s3(args: argparse.Namespace, worker_index: int,
-                       queue: asyncio.Queue):
-    logger = _logger
-    session = aioboto3.Session(profile_name=args.aws_profile,
-                               region_name=args.aws_region)
-    my_name = f'uploader-{worker_index}'
-    logger = logger.bind(worker=my_name)
-    bucket = None
-    async with contextlib.AsyncExitStack() as stack:
-        while True:
-            match await queue.get():
-                case None:
-                    await queue.put(None)
-                    # logger.debug("finished")
-                    return
-                case (path, key):
-                    # noinspection PyBroadException
-                    try:
-                        if bucket is None:
-                            s3 = await stack.enter_async_context(
-                                session.resource('s3'))
-                            bucket = await s3.Bucket(args.s3_bucket)
-                        await bucket.upload_file(f'{path}', key)
-                        logger.info("uploaded", path=path, key=key,
-                                    bucket=args.s3_bucket)
-                    except Exception:
-                        logger.error("upload failed", path=path, key=key,
-                                     bucket=args.s3_bucket,
-                                     exception=traceback.format_exc())
+        return None
+    try:
+        manifest = _json_loads(path.read_bytes())
+    except (OSError, ValueError):
+        logger.error("cannot load manifest", exc=traceback.format_exc())
+        return None
+    members = []
+    scope_prefix = f'files/{scope}/{ts0}/'
+    compat_prefix = f'files/{ts0}/'  # for backward compatibility
+    zip_path = path.with_suffix('.zip')
+    z = None
+    read_ok = False
+    if use_libarchive and libarchive is not None:
+        # The C-backed reader is forward-only, so decompress members
+        # here and carry the bytes to the upload tasks.
+        # noinspection PyBroadException
+        try:
+            with libarchive.public.file_reader(f'{zip_path}') as entries:
+                for entry in entries:
+                    if not entry.filetype.IFREG:
+                        continue
+                    name = entry.pathname
+                    data = b''.join(entry.get_blocks())
+                    members.append((name, scope_prefix + name,
+                                    compat_prefix + name, len(data), data))
+            read_ok = True
+        except Exception:
+            logger.error("libarchive read failed; falling back to zipfile",
+                         exc=traceback.format_exc())
+            members.clear()
+    if not read_ok:
+        try:
+            z = open_zip(zip_path)
+        except (OSError, zipfile.BadZipFile):
+            logger.error("cannot open zip", exc=traceback.format_exc())
+            return None
+        for info in z.infolist():
+            if info.is_dir():
+                continue
+            name = info.filename
+            members.append((name, scope_prefix + name, compat_prefix + name,
+                            info.file_size, None))
+    return scope, ts0, epoch, manifest, z, members
+
+
+async def upload_member(args: argparse.Namespace, tm,
+                        sem: asyncio.Semaphore, backlog: asyncio.Semaphore,
+                        db: sqlite3.Connection,
+                        uploaded: dict, z: zipfile.ZipFile | None,
+                        member: str, key: str, compat_key: str, size: int,
+                        data: bytes | None = None) -> bool:
+    """Upload one zip member (and its backward-compat copy); returns
+    whether both succeeded.  Releases the scanner's backlog slot
+    (acquired at scheduling time) when done."""
+    zip_name = z.filename if z is not None else None
+    # noinspection PyBroadException
+    try:
+        async with sem:
+            if data is None:
+                data = await asyncio.to_thread(z.read, member)
+            buf = io.BytesIO(data)
+            await asyncio.to_thread(
+                tm.upload(buf, args.s3_bucket, key).result)
+            # Server-side copy for the backward-compat key; the bytes
+            # never leave S3.
+            await asyncio.to_thread(
+                tm.copy({'Bucket': args.s3_bucket, 'Key': key},
+                        args.s3_bucket, compat_key).result)
+        uploaded[key] = uploaded[compat_key] = size
+        db.executemany('INSERT OR REPLACE INTO uploads VALUES (?, ?)',
+                       [(key, size), (compat_key, size)])
+        _logger.info("uploaded", zip=zip_name, member=member,
+                     keys=(key, compat_key), bucket=args.s3_bucket)
+        return True
+    except Exception:
+        _logger.error("upload failed", zip=zip_name, member=member,
+                      keys=(key, compat_key), bucket=args.s3_bucket,
+                      exception=traceback.format_exc())
+        return False
+    finally:
+        backlog.release()
+
+
+async def upload_bytes(args: argparse.Namespace, tm,
+                       sem: asyncio.Semaphore, data: bytes, key: str):
+    # noinspection PyBroadException
+    try:
+        async with sem:
+            await asyncio.to_thread(
+                tm.upload(io.BytesIO(data), args.s3_bucket, key).result)
+        _logger.info("uploaded", key=key, bucket=args.s3_bucket)
+    except Exception:
+        _logger.error("upload failed", key=key, bucket=args.s3_bucket,
+                      exception=traceback.format_exc())
+
+
+async def upload_path(args: argparse.Namespace, tm,
+                      sem: asyncio.Semaphore, path, key: str):
+    # noinspection PyBroadException
+    try:
+        async with sem:
+            await asyncio.to_thread(
+                tm.upload(f'{path}', args.s3_bucket, key).result)
+        _logger.info("uploaded", path=path, key=key, bucket=args.s3_bucket)
+    except Exception:
+        _logger.error("upload failed", path=path, key=key,
+                      bucket=args.s3_bucket,
+                      exception=traceback.format_exc())
 
 
 async def run(args):
     # TODO(ek): Use some sort of filesystem monitor
-    manifest_by_scope_ts = dict[str, dict[int, dict]]()
-    timestamps_by_epoch_scope = dict[datetime, dict[str, set[int]]]()
-    while True:
-        _logger.info("starting a run")
-        s3_upload_queue = asyncio.Queue(args.s3_uploaders * 4)
-        uploaders = [
-            asyncio.create_task(
-                upload_to_s3(args, i, s3_upload_queue))
-            for i in range(args.s3_uploaders)
-        ]
-        tmpdir = pathlib.Path(tempfile.mkdtemp())
-        try:
-            for directory in args.directories:
-                directory: pathlib.Path
-                for path in directory.iterdir():
-                    logger = _logger.bind(path=path)
-                    match path.suffix:
-                        case '.json':
-                            try:
-                                ts0 = int(path.stem)
-                            except ValueError:
-                                continue
-                            try:
-                                with path.open() as f:
-                                    manifest = json.load(f)
-                            except (OSError, json.JSONDecodeError):
-                                logger.error("cannot load manifest",
-                                             exc=traceback.format_exc())
+    db = sqlite3.connect(args.state_db)
+    # seen_ts0: manifests already processed, to skip known files
+    # without opening them at all
+    (manifest_by_scope_ts, timestamps_by_epoch_scope, seen_ts0,
+     uploaded) = load_state(db)
+    part_size = args.s3_part_size_mb * 1024 * 1024
+    transfer_config = TransferConfig(
+        multipart_threshold=part_size,
+        multipart_chunksize=part_size,
+        # max_concurrency sizes the manager-wide request pool shared by
+        # all transfers, so budget for every uploader slot.
+        max_concurrency=args.s3_uploaders * args.s3_per_file_concurrency)
+    session = boto3.session.Session(profile_name=args.aws_profile,
+                                    region_name=args.aws_region)
+    s3 = session.client('s3')
+    if args.use_libarchive and libarchive is None:
+        _logger.warning("libarchive not installed; falling back to zipfile")
+    # One transfer manager (and thread pool) shared by all uploads;
+    # its threads release the GIL during socket I/O.
+    # noinspection PyBroadException
+    try:
+        # Refresh the uploaded-key cache from the bucket so a restart
+        # with a stale or missing state DB still skips existing
+        # objects.
+        uploaded.update(
+            await asyncio.to_thread(list_uploaded, s3, args.s3_bucket))
+    except Exception:
+        _logger.error("cannot list uploaded keys", bucket=args.s3_bucket,
+                      exception=traceback.format_exc())
+    with create_transfer_manager(s3, transfer_config) as tm:
+        while True:
+            _logger.info("starting a run")
+            sem = asyncio.Semaphore(args.s3_uploaders)
+            # Caps how far scanning may run ahead of the uploads (the
+            # old queue's bound), which also bounds decompressed member
+            # data held by pending tasks on the libarchive path.
+            backlog = asyncio.Semaphore(args.s3_uploaders * 4)
+            async with asyncio.TaskGroup() as tg:
+                state_lock = asyncio.Lock()
+
+                async def finalize_manifest(scope, ts0, epoch,
+                                            manifest, z, member_tasks):
+                    # Persist the manifest only once every member
+                    # upload succeeded; otherwise forget it so the
+                    # next cycle retries the missing uploads.
+                    try:
+                        ok = all(await asyncio.gather(*member_tasks))
+                    finally:
+                        if z is not None:
+                            z.close()
+                    async with state_lock:
+                        if ok:
+                            seen_ts0.add(ts0)
+                            db.execute(
+                                'INSERT OR IGNORE INTO'
+                                ' manifests VALUES (?, ?, ?, ?)',
+                                (scope, ts0, epoch.isoformat(),
+                                 _json_dumps(manifest)))
+                        else:
+                            manifest_by_scope_ts \
+                                .get(scope, {}).pop(ts0, None)
+                            timestamps_by_epoch_scope \
+                                .get(epoch, {}) \
+                                .get(scope, set()) \
+                                .discard(ts0)
+                            _logger.warning(
+                                "manifest uploads incomplete;"
+                                " will retry next run",
+                                scope=scope, ts0=ts0)
+
+                async def scan_directory(directory: pathlib.Path):
+                    with os.scandir(directory) as entries:
+                        for entry in entries:
+                            if not entry.name.endswith('.json'):
                                 continue
                             try:
-                                epoch = parse_timestamp(manifest['epoch'])
-                                ts = parse_timestamp(manifest['issuanceDate'])
-                                scope = manifest['scope']
-                            except KeyError:
-                                # logger.error("invalid manifest",
-                                #              exc=traceback.format_exc())
-                                continue
+                                ts0 = int(
+                                    entry.name[:-len('.json')])
                             except ValueError:
-                                logger.error(
-                                    "invalid epoch/issuance/effective date",
-                                    exc=traceback.format_exc())
                                 continue
-                            if not isinstance(scope, str):
-                                logger.error("scope not a string")
+                            if ts0 in seen_ts0:
                                 continue
-                            assert round(ts.timestamp() * 1000) == ts0
-                            try:
-                                manifest_by_scope_ts[scope][ts0]
-                            except KeyError:
-                                pass
-                            else:
+                            result = await asyncio.to_thread(
+                                process_manifest,
+                                pathlib.Path(entry.path),
+                                ts0, manifest_by_scope_ts,
+                                args.use_libarchive)
+                            if result is None:
                                 continue
-                            with zipfile.ZipFile(
-                                    path.with_suffix('.zip')) as z:
-                                zipdir = tmpdir / scope / path.stem
-                                z.extractall(zipdir)
-                                for path2 in zipdir.iterdir():
-                                    if path2.is_file():
-                                        relpath = path2.relative_to(zipdir)
-                                        await s3_upload_queue.put((
-                                            f'{path2}',
-                                            f'files/{scope}/{ts0}/{relpath}',
-                                        ))
-                                        # for backward compatibility
-                                        await s3_upload_queue.put((
-                                            f'{path2}',
-                                            f'files/{ts0}/{relpath}',
-                                        ))
+                            (scope, ts0, epoch, manifest, z,
+                             members) = result
+                            async with state_lock:
+                                if ts0 in seen_ts0 \
+                                        or ts0 in manifest_by_scope_ts \
+                                        .get(scope, {}):
+                                    # Another directory scan
+                                    # beat us to this manifest.
+                                    if z is not None:
+                                        z.close()
+                                    continue
+                                member_tasks = []
+                                for (member, key, compat_key,
+                                     size, data) in members:
+                                    if uploaded.get(key) == size \
+                                            and uploaded.get(
+                                                compat_key) == size:
+                                        continue
+                                    await backlog.acquire()
+                                    member_tasks.append(
+                                        tg.create_task(upload_member(
+                                            args, tm, sem, backlog, db,
+                                            uploaded, z, member, key,
+                                            compat_key, size, data)))
+                                manifest_by_scope_ts \
+                                    .setdefault(scope, {})[ts0] \
+                                    = manifest
+                                timestamps_by_epoch_scope \
+                                    .setdefault(epoch, {}) \
+                                    .setdefault(scope, set()) \
+                                    .add(ts0)
+                                tg.create_task(finalize_manifest(
+                                    scope, ts0, epoch, manifest, z,
+                                    member_tasks))
+
+                await asyncio.gather(*(
+                    scan_directory(directory)
+                    for directory in args.directories))
+                try:
+                    max_epoch = max(timestamps_by_epoch_scope.keys())
+                except ValueError:
+                    continue
+                all_ts = set().union(
+                    *timestamps_by_epoch_scope[max_epoch].values())
+                timestamps = [str(ts) for ts in sorted(all_ts)]
+                # Listings go straight from memory; no temp file.
+                tg.create_task(upload_bytes(
+                    args, tm, sem, _json_dumps(timestamps),
+                    'api/scores/timestamps.json'))
+                list_ = {}
+                for (scope, timestamps) in \
+                        timestamps_by_epoch_scope[max_epoch].items():
+                    for ts in timestamps:
+                        manifest = manifest_by_scope_ts[scope][ts]
+                        list_[str(ts)] = manifest
+                tg.create_task(upload_bytes(
+                    args, tm, sem, _json_dumps(list_),
+                    'api/scores/list.json'))
+                tg.create_task(upload_path(
+                    args, tm, sem,
+                    args.indexer_cache, 'api/scores/indexer-scores'))
+                # Older epochs no longer contribute to the
+                # listings; evict them from disk and memory so
+                # state stays bounded.
+                db.execute('DELETE FROM manifests WHERE epoch < ?',
+                           (max_epoch.isoformat(),))
+                db.commit()
+                for old_epoch in [e for e
+                                  in timestamps_by_epoch_scope
+                                  if e < max_epoch]:
+                    by_scope = timestamps_by_epoch_scope.pop(
+                        old_epoch)
+                    for old_scope, old_tss in by_scope.items():
+                        for old_ts in old_tss:
                             manifest_by_scope_ts \
-                                .setdefault(scope, {})[ts0] \
-                                = manifest
-                            timestamps_by_epoch_scope \
-                                .setdefault(epoch, {}) \
-                                .setdefault(scope, set()) \
-                                .add(ts0)
-            try:
-                max_epoch = max(timestamps_by_epoch_scope.keys())
-            except ValueError:
-                continue
-            timestamps = [str(ts)
-                          for ts in sorted(reduce(lambda x, y: x | y,
-                                                  timestamps_by_epoch_scope[
-                                                      max_epoch].values()))]
-            timestamps_json = tmpdir / 'timestamps.json'
-            with timestamps_json.open('w') as f:
-                json.dump(timestamps, f)
-            await s3_upload_queue.put(
-                (f'{timestamps_json}', 'api/scores/timestamps.json'))
-            list_ = {}
-            for (scope, timestamps) in \
-                    timestamps_by_epoch_scope[max_epoch].items():
-                for ts in timestamps:
-                    manifest = manifest_by_scope_ts[scope][ts]
-                    list_[str(ts)] = manifest
-            list_json = tmpdir / 'list.json'
-            with list_json.open('w') as f:
-                json.dump(list_, f)
-            await s3_upload_queue.put(
-                (f'{list_json}', 'api/scores/list.json'))
-            await s3_upload_queue.put(
-                (f'{args.indexer_cache}', 'api/scores/indexer-scores'))
-            _logger.info("finished a run")
-        finally:
-            await s3_upload_queue.put(None)
-            await asyncio.gather(*uploaders, return_exceptions=True)
+                                .get(old_scope, {}) \
+                                .pop(old_ts, None)
+                _logger.info("finished a run")
+            db.commit()  # uploads recorded while the group drained
             _logger.info("all uploads finished")
-            rm_rf(tmpdir)
-        await asyncio.sleep(10)
+            await asyncio.sleep(10)